@@ -383,6 +383,7 @@ class Core(commands.Cog):
             return
         
         self.set_guild_global_setting(interaction.guild, 'Timezone', timezone)
+        self.bot.dispatch('guild_timezone_update', interaction.guild)
         await interaction.response.send_message(f"**Succès** • Le fuseau horaire du serveur a été défini sur `{timezone}`.", ephemeral=True)
         
     @cmd_config_timezone.autocomplete('timezone')
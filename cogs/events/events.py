@@ -101,6 +101,7 @@ class Events(commands.Cog):
         
         self.__reminders_cache : dict[int, list[dict]] = {}
         self.__reminders_share_cooldown : dict[int, int] = {}
+        self.__tz_cache : dict[int, tzinfo] = {}
         
     @commands.Cog.listener()
     async def on_ready(self):
@@ -202,6 +203,11 @@ class Events(commands.Cog):
             message = EVENTS_TYPES['on_member_unban']['default'].format(member=user, guild=guild, time=datetime.now(tz=tz).strftime('%H:%M'))
         await channel.send(message, allowed_mentions=discord.AllowedMentions.none())
         
+    @commands.Cog.listener()
+    async def on_guild_timezone_update(self, guild: discord.Guild):
+        """Invalide le fuseau horaire en cache lorsqu'il est modifié"""
+        self.__tz_cache.pop(guild.id, None)
+        
     # Partage des rappels ----------------------------
     
     @commands.Cog.listener()
@@ -417,11 +423,14 @@ class Events(commands.Cog):
     def get_timezone(self, guild: discord.Guild | None = None) -> tzinfo:
         if not guild:
             return pytz.timezone('Europe/Paris')
+        if guild.id in self.__tz_cache:
+            return self.__tz_cache[guild.id]
         core : Core = self.bot.get_cog('Core') # type: ignore
         if not core:
             return pytz.timezone('Europe/Paris')
-        tz = core.get_guild_global_setting(guild, 'Timezone')
-        return pytz.timezone(tz) 
+        tz = pytz.timezone(core.get_guild_global_setting(guild, 'Timezone'))
+        self.__tz_cache[guild.id] = tz
+        return tz
     
     def extract_time_from_string(self, string: str, tz: tzinfo) -> datetime | None:
         """Extrait une date d'une chaîne de caractères
@@ -1,6 +1,6 @@
 import asyncio
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Any
 
 import aiohttp
@@ -43,6 +43,8 @@ class MsgBoard(commands.Cog):
         )
         self.data.append_initializers_for(discord.Guild, [board_history])
         
+        self._msg_locks : dict[int, asyncio.Lock] = {}
+        
         self.clean_history.start()
         
     def cog_unload(self):
@@ -60,6 +62,12 @@ class MsgBoard(commands.Cog):
             
             self.data.get(guild).execute("DELETE FROM board_history WHERE timestamp < ?", (int(datetime.utcnow().timestamp()) - HISTORY_EXPIRATION,))
             
+        # On retire les verrous des messages de plus de 24h qui ne sont plus utilisés
+        lock_limit = discord.utils.utcnow() - timedelta(hours=24)
+        for message_id, lock in list(self._msg_locks.items()):
+            if not lock.locked() and discord.utils.snowflake_time(message_id) < lock_limit:
+                del self._msg_locks[message_id]
+            
     # Webhook -----------------------------------------------------------------
     
     async def repost_message(self, message: discord.Message):
@@ -117,8 +125,8 @@ class MsgBoard(commands.Cog):
         if not isinstance(message.guild, discord.Guild):
             raise ValueError("Le message doit être sur un serveur.")
         
-        r = self.data.get(message.guild).fetchone("SELECT * FROM board_history WHERE message_id = ?", (message.id,))
-        return dict(r) if r else dict()
+        r = self.data.get(message.guild).fetchone("SELECT reposted, notification_id FROM board_history WHERE message_id = ?", (message.id,))
+        return {'reposted': r[0], 'notification_id': r[1]} if r else dict()
     
     def set_message_history(self, message: discord.Message, *, reposted: bool = False, notification_id: int = 0):
         """Modifie l'historique d'un message."""
@@ -134,42 +142,33 @@ class MsgBoard(commands.Cog):
         if notification_id:
             self.data.get(message.guild).execute("UPDATE board_history SET notification_id = ? WHERE message_id = ?", (notification_id, message.id))
     
-    async def send_half_threshold_notification(self, message: discord.Message, current_votes: int):
+    async def send_half_threshold_notification(self, message: discord.Message, current_votes: int, bot_perms: discord.Permissions):
         """Envoie une notification lorsque le seuil de notification est atteint."""
         if not isinstance(message.guild, discord.Guild) or not isinstance(message.author, discord.Member):
             raise TypeError("Le message doit provenir d'un membre d'un serveur.")
         
-        channel = message.channel
-        if not channel.permissions_for(message.guild.me).manage_messages:
+        if not bot_perms.manage_messages:
             return
         
         threshold = self.data.get_collection_value(message.guild, 'settings', 'Threshold')
         emoji = self.data.get_collection_value(message.guild, 'settings', 'Emoji')
         
         text = f"`{emoji}` **Popularité montante** • Ce message possède {current_votes} votes et sera reposté s'il atteint {threshold}{emoji} !"
-        notif_msg = await message.reply(text, mention_author=False)
+        notif_msg = await message.reply(text, delete_after=120, mention_author=False)
         self.set_message_history(message, notification_id=notif_msg.id)
         
-        await asyncio.sleep(120)
-        try:
-            await notif_msg.delete()
-        except discord.NotFound:
-            pass
-        
-    async def send_threshold_notification(self, message: discord.Message):
+    async def send_threshold_notification(self, message: discord.Message, bot_perms: discord.Permissions):
         """Envoie une notification lorsque le seuil de repost est atteint."""
         if not isinstance(message.guild, discord.Guild) or not isinstance(message.author, discord.Member):
             raise TypeError("Le message doit provenir d'un membre d'un serveur.")
         
-        channel = message.channel
-        if not channel.permissions_for(message.guild.me).manage_messages:
+        if not bot_perms.manage_messages:
             return
         
         emoji = self.data.get_collection_value(message.guild, 'settings', 'Emoji')
         
         text = f"## `{emoji}` **Message populaire** • Ce message a été reposté sur le salon de compilation !"
         await message.reply(text, delete_after=60, mention_author=False)
-        self.set_message_history(message, reposted=True)
         
     # Events ------------------------------------------------------------------	
     
@@ -180,7 +179,8 @@ class MsgBoard(commands.Cog):
             return
         if not channel.guild:
             return
-        if not channel.permissions_for(channel.guild.me).read_message_history:
+        bot_perms = channel.permissions_for(channel.guild.me)
+        if not bot_perms.read_message_history:
             return
         guild = channel.guild
         if not self.data.get_collection_value(guild, 'settings', 'Webhook_URL'):
@@ -206,22 +206,34 @@ class MsgBoard(commands.Cog):
         threshold = self.data.get_collection_value(guild, 'settings', 'Threshold', cast=int)
         
         notif = self.data.get_collection_value(guild, 'settings', 'NotifyHalfThreshold', cast=bool)
-        if notif:
-            notif_threshold = threshold // 2 + 1
-            if votes_count == notif_threshold and not self.get_message_history(message).get('notification_id'):
-                await self.send_half_threshold_notification(message, votes_count)
-        
-        if votes_count == threshold and not self.get_message_history(message).get('reposted'):
-            notif_message_id = self.get_message_history(message).get('notification_id')
-            if notif_message_id:
-                try:
-                    notif_message = await channel.fetch_message(notif_message_id)
-                    await notif_message.delete()
-                except discord.NotFound:
-                    pass
+        
+        # On verrouille le message pour éviter qu'une rafale de réactions ne provoque plusieurs reposts
+        lock = self._msg_locks.setdefault(message.id, asyncio.Lock())
+        async with lock:
+            history = self.get_message_history(message)
+            if notif:
+                notif_threshold = threshold // 2 + 1
+                if votes_count == notif_threshold and not history.get('notification_id'):
+                    await self.send_half_threshold_notification(message, votes_count, bot_perms)
             
-            await self.send_threshold_notification(message)
-            await self.repost_message(message)
+            if votes_count >= threshold and not history.get('reposted'):
+                self.set_message_history(message, reposted=True)
+                notif_message_id = history.get('notification_id')
+                if notif_message_id:
+                    try:
+                        notif_message = await channel.fetch_message(notif_message_id)
+                        await notif_message.delete()
+                    except discord.NotFound:
+                        pass
+                
+                results = await asyncio.gather(
+                    self.send_threshold_notification(message, bot_perms),
+                    self.repost_message(message),
+                    return_exceptions=True
+                )
+                for result in results:
+                    if isinstance(result, Exception):
+                        logger.error(f"Erreur lors du traitement du message populaire {message.id} : {result}", exc_info=result)
             
     # Configuration ============================================================
     
@@ -378,7 +390,10 @@ class MsgBoard(commands.Cog):
         if not self.data.get_collection_value(interaction.guild, 'settings', 'Enabled', cast=bool):
             return await interaction.response.send_message("**Erreur** • Activez d'abord le message board avec `/msgboard enable`.", ephemeral=True)
         
-        await self.repost_message(message)
+        # Le message est marqué comme reposté pour que les votes suivants ne le repostent pas une seconde fois
+        async with self._msg_locks.setdefault(message.id, asyncio.Lock()):
+            self.set_message_history(message, reposted=True)
+            await self.repost_message(message)
         await interaction.response.send_message(f"**Succès** • Le message a été reposté sur le salon de compilation.", ephemeral=True)
     
         
@@ -1,19 +1,20 @@
-import copy
+import asyncio
 import logging
+import math
 import re
 import cv2
 import textwrap
+from collections import OrderedDict
 from io import BytesIO
 from typing import List, Optional, Tuple
 
 import aiohttp
-import colorgram
 import discord
 import numpy as np
 from discord import Interaction, app_commands
 from discord.components import SelectOption
-from discord.ext import commands
-from PIL import Image, ImageDraw, ImageFont, ImageChops
+from discord.ext import commands, tasks
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 
 from common import dataio
 from common.utils import pretty
@@ -22,6 +23,18 @@ logger = logging.getLogger(f'NERON.{__name__.split(".")[-1]}')
 
 QUOTE_EXPIRATION = 60 * 60 * 24 * 30 # 30 jours
 DEFAULT_QUOTE_IMAGE_SIZE = (650, 650)
+BACKGROUNDS_CACHE_SIZE = 128
+MQ_BACKGROUNDS_CACHE_SIZE = 64
+CORNER_MASKS_CACHE_SIZE = 32
+QUOTE_PNG_CACHE_SIZE = 32
+QUOTE_PNG_CACHE_MAX_BYTES = 24 * 1024 * 1024 # Taille totale maximale des citations gardées en cache (~1 Mo chacune)
+HTTP_TIMEOUT = 15 # secondes
+INSPIROBOT_API_URL = 'https://inspirobot.me/api?generate=true'
+INSPIROBOT_PREFETCH_SIZE = 3 # URLs de citations Inspirobot gardées d'avance
+AVATAR_FORMATS = ('PNG', 'WEBP', 'JPEG', 'GIF') # Formats servis par le CDN Discord
+
+CUSTOM_EMOJI_REGEX = re.compile(r'<a?:(\w+):\d+>')
+MARKDOWN_STRIP_TABLE = str.maketrans('', '', '*_`~\\')
 
 # QUOTIFY =====================================================================$
 
@@ -36,11 +49,14 @@ class QuotifyMessageSelect(discord.ui.Select):
         
     async def callback(self, interaction: discord.Interaction):
         await interaction.response.defer()
-        if sum([len(m.clean_content) for m in self.__view.selected_messages]) > 1000:
+        if sum(len(self.__view.contents[m.id]) for m in self.__view.selected_messages) > 1000:
             return await interaction.followup.send("**Action impossible** · Le message est trop long", ephemeral=True)
         
-        self.__view.selected_messages = [m for m in self.__view.potential_messages if m.id in [int(v) for v in self.values]]
-        self.options = [SelectOption(label=f"{pretty.shorten_text(m.clean_content, 100)}", value=str(m.id), description=m.created_at.strftime('%H:%M %d/%m/%y'), default=str(m.id) in self.values) for m in self.__view.potential_messages]
+        values = set(self.values)
+        self.__view.selected_messages = [m for m in self.__view.potential_messages if str(m.id) in values]
+        # Les options sont construites une seule fois : seule la sélection par défaut change
+        for option in self.options:
+            option.default = option.value in values
         image = await self.__view._get_image()
         if not image:
             return await interaction.followup.send("**Erreur** · Impossible de créer l'image de la citation", ephemeral=True)
@@ -54,6 +70,7 @@ class QuotifyView(discord.ui.View):
         self.initial_message = initial_message
         self.potential_messages = []
         self.selected_messages = [initial_message]
+        self.contents : dict[int, str] = {}
         
         self.interaction : Interaction | None = None
         
@@ -77,11 +94,12 @@ class QuotifyView(discord.ui.View):
         await interaction.response.defer()
         
         potential_msgs = await self.__cog.fetch_following_messages(self.initial_message)
-        if sum([len(m.clean_content) for m in potential_msgs]) > 1000:
+        self.contents = {m.id: m.clean_content for m in potential_msgs}
+        if sum(len(c) for c in self.contents.values()) > 1000:
             return await interaction.followup.send("**Action impossible** · Le message est trop long", ephemeral=True)
-        self.potential_messages = sorted(potential_msgs, key=lambda m: m.created_at)
+        self.potential_messages = potential_msgs # Déjà dans l'ordre chronologique
         if len(self.potential_messages) > 1:
-            options = [SelectOption(label=f"{pretty.shorten_text(m.clean_content, 100)}", value=str(m.id), description=m.created_at.strftime('%H:%M %d/%m/%y'), default= m == self.initial_message) for m in self.potential_messages]
+            options = [SelectOption(label=pretty.shorten_text(self.contents[m.id], 100), value=str(m.id), description=m.created_at.strftime('%H:%M %d/%m/%y'), default= m == self.initial_message) for m in self.potential_messages]
             self.add_item(QuotifyMessageSelect(self, "Sélectionnez les messages à citer", options))
         
         image = await self._get_image()
@@ -131,8 +149,11 @@ class MultQuotifyMessageSelect(discord.ui.Select):
         
     async def callback(self, interaction: discord.Interaction):
         await interaction.response.defer()
-        self.__view.selected_messages = [m for m in self.__view.potential_messages if m.id in [int(v) for v in self.values]]
-        self.options = [SelectOption(label=f"{m.author.name} : {pretty.shorten_text(m.clean_content, 50)}", value=str(m.id), description=m.created_at.strftime('%H:%M %d/%m/%y'), default=str(m.id) in self.values) for m in self.__view.potential_messages]
+        values = set(self.values)
+        self.__view.selected_messages = [m for m in self.__view.potential_messages if str(m.id) in values]
+        # Les options sont construites une seule fois : seule la sélection par défaut change
+        for option in self.options:
+            option.default = option.value in values
         image = await self.__view._get_image()
         if not image:
             return await interaction.followup.send("**Erreur** · Impossible de créer l'image de la citation", ephemeral=True)
@@ -169,7 +190,7 @@ class MultQuotifyView(discord.ui.View):
         await interaction.response.defer()
         
         potential_msgs = await self.__cog.fetch_following_messages_multiple_authors(self.initial_message)
-        self.potential_messages = sorted(potential_msgs, key=lambda m: m.created_at)
+        self.potential_messages = potential_msgs # Déjà dans l'ordre chronologique
         if len(self.potential_messages) > 1:
             options = [SelectOption(label=f"{m.author.name} : {pretty.shorten_text(m.clean_content, 50)}", value=str(m.id), description=m.created_at.strftime('%H:%M %d/%m/%y'), default= m == self.initial_message) for m in self.potential_messages]
             self.add_item(MultQuotifyMessageSelect(self, "Sélectionnez les messages à ajouter", options))
@@ -230,10 +251,25 @@ class Quotes(commands.Cog):
         
         self.__assets = {} # Assets préchargés
         self.__fonts = {} # Polices préchargées
-        self.__backgrounds = {} # Avatars avec leurs dégradés précalculés
+        self.__line_spacings = {} # Interlignes des polices préchargées
+        assets_path = self.data.get_folder('assets')
+        self.__font_paths = {name: str(assets_path / f'{name}.ttf') for name in ('NotoBebasNeue', 'gg_sans', 'gg_sans_semi')} # Chemins des polices
+        self.__overlays = {} # Calques d'icône et de lignes par taille et couleur
+        self.__backgrounds : OrderedDict[tuple[int, str], tuple[Image.Image, tuple[int, int, int]]] = OrderedDict() # Avatars avec leurs dégradés précalculés
+        self.__mq_backgrounds : OrderedDict[tuple[int, str, int, int], tuple[Image.Image, Image.Image]] = OrderedDict() # Fonds floutés des citations multiples
+        self.__corner_masks : OrderedDict[tuple, Image.Image] = OrderedDict() # Masques d'arrondis précalculés
+        self.__quote_png_cache : OrderedDict[tuple, bytes] = OrderedDict() # Citations déjà générées (PNG)
+        self.__quote_png_cache_bytes = 0
+        
+        self._http : Optional[aiohttp.ClientSession] = None # Session HTTP partagée (Inspirobot)
+        self._inspirobot_urls : asyncio.Queue[str] = asyncio.Queue(maxsize=INSPIROBOT_PREFETCH_SIZE)
+        self.prefetch_inspirobot.start()
         
     def cog_unload(self):
         self.data.close_all()
+        self.prefetch_inspirobot.cancel()
+        if self._http and not self._http.closed:
+            asyncio.create_task(self._http.close())
         
     @commands.Cog.listener()
     async def on_ready(self):
@@ -248,15 +284,16 @@ class Quotes(commands.Cog):
         self.__assets = assets
     
     def __load_common_fonts(self): # Préchargement des polices selon DEFAULT_QUOTE_IMAGE_SIZE
-        assets_path = self.data.get_folder('assets')
-        font_path = str(assets_path / "NotoBebasNeue.ttf")
-        self.__get_font(font_path, int(DEFAULT_QUOTE_IMAGE_SIZE[1] * 0.08)) # Texte principal
+        font_path = self.__font_paths['NotoBebasNeue']
+        # Texte principal (toutes les tailles atteignables lors de l'ajustement à la boîte de texte)
+        for size in range(int(DEFAULT_QUOTE_IMAGE_SIZE[1] * 0.04), int(DEFAULT_QUOTE_IMAGE_SIZE[1] * 0.08) + 1):
+            self.__get_font(font_path, size)
         self.__get_font(font_path, int(DEFAULT_QUOTE_IMAGE_SIZE[1] * 0.060)) # Auteur
         self.__get_font(font_path, int(DEFAULT_QUOTE_IMAGE_SIZE[1] * 0.040)) # Date
         
-        self.__get_font(str(assets_path / "gg_sans.ttf"), 40) # Nom de l'auteur
-        self.__get_font(str(assets_path / "gg_sans.ttf"), 24) # Nom de l'auteur (petit)
-        self.__get_font(str(assets_path / "gg_sans_semi.ttf"), 32) # Contenu du message
+        self.__get_font(self.__font_paths['gg_sans'], 40) # Nom de l'auteur
+        self.__get_font(self.__font_paths['gg_sans'], 24) # Nom de l'auteur (petit)
+        self.__get_font(self.__font_paths['gg_sans_semi'], 32) # Contenu du message
     
     def __get_font(self, font_path: str, size: int) -> ImageFont.FreeTypeFont:
         """Récupère une police depuis le cache ou charge une nouvelle police"""
@@ -265,56 +302,146 @@ class Quotes(commands.Cog):
             self.__fonts[key] = ImageFont.truetype(font_path, size, encoding='unic')
         return self.__fonts[key]
     
+    def __get_line_spacing(self, font_path: str, size: int) -> int:
+        """Récupère depuis le cache l'interligne utilisé par multiline_text pour une police (hauteur de "A")"""
+        key = (font_path, size)
+        if key not in self.__line_spacings:
+            self.__line_spacings[key] = self.__get_font(font_path, size).getbbox("A")[3]
+        return self.__line_spacings[key]
+    
     async def __get_background(self, user: discord.Member) -> Tuple[Image.Image, Tuple[int, int, int]]:
         """Récupère un avatar avec dégradé depuis le cache ou le génère"""
-        if user.id not in self.__backgrounds:
-            size = DEFAULT_QUOTE_IMAGE_SIZE
-            avatar = BytesIO(await user.display_avatar.read())
-            image = Image.open(avatar).resize(size)
-            bg_color = colorgram.extract(image.resize((32, 32)), 1)[0].rgb 
-            grad_magnitude = 0.875
-            image = self._add_gradientv2(image, grad_magnitude, bg_color)
-            self.__backgrounds[user.id] = (image, bg_color)
-        return self.__backgrounds[user.id]
+        # La clé de l'avatar fait partie de la clé de cache : un changement d'avatar n'est jamais servi périmé
+        key = (user.id, user.display_avatar.key)
+        if key in self.__backgrounds:
+            self.__backgrounds.move_to_end(key)
+            return self.__backgrounds[key]
+        
+        avatar_data = await user.display_avatar.read()
+        # Décodage, redimensionnement et dégradé sont faits dans un thread pour ne pas bloquer la boucle
+        background = await asyncio.to_thread(self._render_background, avatar_data, DEFAULT_QUOTE_IMAGE_SIZE)
+        self.__backgrounds[key] = background
+        if len(self.__backgrounds) > BACKGROUNDS_CACHE_SIZE:
+            self.__backgrounds.popitem(last=False)
+        return background
+    
+    def _render_background(self, avatar_data: bytes, size: Tuple[int, int]) -> Tuple[Image.Image, Tuple[int, int, int]]:
+        """Redimensionne un avatar et y applique un dégradé de sa couleur dominante"""
+        image = Image.open(BytesIO(avatar_data), formats=AVATAR_FORMATS).resize(size)
+        bg_color = self._dominant_color(image)
+        grad_magnitude = 0.875
+        # L'image redimensionnée nous appartient : inutile d'en faire une copie RGBA supplémentaire
+        return self._add_gradientv2(image, grad_magnitude, bg_color, in_place=True), bg_color
+    
+    async def _get_blurred_bgs(self, users_heights: list[tuple[discord.User | discord.Member, int]], width: int) -> list[Tuple[Image.Image, Image.Image]]:
+        """Récupère les fonds floutés et avatars arrondis de plusieurs utilisateurs depuis le cache ou les génère en parallèle"""
+        # Comme pour __backgrounds, la clé de l'avatar fait partie de la clé de cache
+        keys = [(user.id, user.display_avatar.key, width, height) for user, height in users_heights]
+        # Les valeurs en cache sont copiées avant toute attente : une éviction concurrente ne peut plus les faire disparaître
+        found = {key: self.__mq_backgrounds[key] for key in keys if key in self.__mq_backgrounds}
+        missing = {key: user for key, (user, _) in zip(keys, users_heights) if key not in found}
+        if missing:
+            # Les avatars sont téléchargés une seule fois par auteur puis les fonds sont générés dans des threads
+            users = {user.id: user for user in missing.values()}
+            avatars = dict(zip(users.keys(), await asyncio.gather(*[u.display_avatar.read() for u in users.values()])))
+            loop = asyncio.get_running_loop()
+            rendered = await asyncio.gather(*[loop.run_in_executor(None, self._render_blurred_bg, avatars[key[0]], width, key[3]) for key in missing])
+            found.update(zip(missing, rendered))
+        
+        for key in keys:
+            self.__mq_backgrounds[key] = found[key]
+            self.__mq_backgrounds.move_to_end(key)
+        while len(self.__mq_backgrounds) > MQ_BACKGROUNDS_CACHE_SIZE:
+            self.__mq_backgrounds.popitem(last=False)
+        return [found[key] for key in keys]
+    
+    def _render_blurred_bg(self, avatar_data: bytes, width: int, height: int) -> Tuple[Image.Image, Image.Image]:
+        """Génère le fond flouté et l'avatar arrondi d'une citation multiple à partir de l'avatar brut"""
+        disp_avatar = Image.open(BytesIO(avatar_data), formats=AVATAR_FORMATS).convert('RGBA')
+        
+        # On ajoute le fond avec cv2 (on crop l'avatar avec pillow avant)
+        bg = disp_avatar.resize((width, width))
+        if bg.height > height:
+            # On crop pour avoir height en hauteur (milieu de l'image)
+            bg = bg.crop((0, (bg.height - height) // 2, bg.width, (bg.height - height) // 2 + height))
+        elif bg.height < height:
+            # On resize pour avoir height en hauteur (milieu de l'image)
+            bg = bg.resize((height, height), Image.LANCZOS)
+            bg = bg.crop(((bg.width - width) // 2, 0, (bg.width - width) // 2 + width, bg.height))
+        # Flou et dégradé noir (de droite à gauche) appliqués directement sur le tableau NumPy
+        # Le flou est calculé sur une version réduite (÷4) avec un noyau 4x plus petit puis agrandi, visuellement équivalent
+        bg_np = cv2.resize(np.asarray(bg.convert('RGB')), (width // 4, height // 4), interpolation=cv2.INTER_AREA)
+        bg_np = cv2.GaussianBlur(bg_np, (29, 29), 0, borderType=cv2.BORDER_REPLICATE)
+        bg_np = cv2.resize(bg_np, (width, height), interpolation=cv2.INTER_LINEAR)
+        grad = ((width - np.arange(width, dtype=np.float32)) * (0.9 / width))[None, :, None]
+        bg_f = bg_np.astype(np.float32)
+        bg_f *= 1 - grad
+        bg_np = bg_f.astype(np.uint8)
+        bg = Image.fromarray(bg_np)
+        
+        # Avatar arrondi affiché à gauche
+        avatar = disp_avatar.resize((240, 240))
+        avatar = self._round_corners(avatar, 30)
+        avatar = avatar.resize((120, 120), Image.LANCZOS)
+        return bg, avatar
         
     # Génération de citations -------------------------------------------------
     
-    def _add_gradientv2(self, image: Image.Image, gradient_magnitude=1.0, color: Tuple[int, int, int]=(0, 0, 0)):
-        width, height = image.size
-
-        gradient = Image.new('RGBA', (width, height), color)
-        draw = ImageDraw.Draw(gradient)
-
-        end_alpha = int(gradient_magnitude * 255)
-
-        for y in range(height):
-            alpha = int((y / height) * end_alpha)
-            draw.line([(0, y), (width, y)], fill=(color[0], color[1], color[2], alpha))
-
-        gradient_im = Image.alpha_composite(image.convert('RGBA'), gradient)
+    def _dominant_color(self, image: Image.Image) -> Tuple[int, int, int]:
+        """Renvoie la couleur dominante d'une image (quantifiée sur 5 bits par canal)"""
+        arr = np.asarray(image.resize((32, 32)).convert('RGB'), dtype=np.uint8).reshape(-1, 3)
+        q = (arr[:, 0] >> 3).astype(np.uint32) | ((arr[:, 1] >> 3).astype(np.uint32) << 5) | ((arr[:, 2] >> 3).astype(np.uint32) << 10)
+        idx = int(np.bincount(q).argmax())
+        return ((idx & 31) << 3, ((idx >> 5) & 31) << 3, ((idx >> 10) & 31) << 3)
+    
+    def _gradient_mask(self, size: Tuple[int, int], gradient_magnitude=1.0) -> Image.Image:
+        """Génère un masque de dégradé linéaire vertical (mode L) entièrement avec les fonctions C de Pillow"""
+        width, height = size
+        mask = Image.linear_gradient('L').resize((width, height))
+        if gradient_magnitude != 1.0:
+            magnitude = min(gradient_magnitude, 1.0)
+            mask = mask.point(lambda v: int(v * magnitude))
+        return mask
+    
+    def _add_gradientv2(self, image: Image.Image, gradient_magnitude=1.0, color: Tuple[int, int, int]=(0, 0, 0), *, in_place: bool = False):
+        """Applique un dégradé de couleur sur l'image (modifiée directement si in_place et déjà en RGBA)"""
+        gradient = Image.new('RGBA', image.size, color)
+        gradient.putalpha(self._gradient_mask(image.size, gradient_magnitude))
+
+        # convert() renvoie déjà une copie : on compose directement dessus plutôt que d'allouer une troisième image
+        gradient_im = image if in_place and image.mode == 'RGBA' else image.convert('RGBA')
+        gradient_im.alpha_composite(gradient)
         return gradient_im
     
     def _round_corners(self, img: Image.Image, rad: int, *,
                     top_left: bool = True, top_right: bool = True, 
                     bottom_left: bool = True, bottom_right: bool = True) -> Image.Image:
-        circle = Image.new('L', (rad * 2, rad * 2), 0)
-        draw = ImageDraw.Draw(circle)
-        draw.ellipse((0, 0, rad * 2, rad * 2), fill=255)
-        
         w, h = img.size
+        key = (w, h, rad, top_left, top_right, bottom_left, bottom_right)
+        # Peut être appelé depuis plusieurs threads : on évite les accès en deux temps au cache
+        mask = self.__corner_masks.get(key)
+        if mask is None:
+            circle = Image.new('L', (rad * 2, rad * 2), 0)
+            draw = ImageDraw.Draw(circle)
+            draw.ellipse((0, 0, rad * 2, rad * 2), fill=255)
+            
+            mask = Image.new('L', img.size, 255)
+            if top_left:
+                mask.paste(circle.crop((0, 0, rad, rad)), (0, 0))
+            if top_right:
+                mask.paste(circle.crop((rad, 0, rad * 2, rad)), (w - rad, 0))
+            if bottom_left:
+                mask.paste(circle.crop((0, rad, rad, rad * 2)), (0, h - rad))
+            if bottom_right:
+                mask.paste(circle.crop((rad, rad, rad * 2, rad * 2)), (w - rad, h - rad))
+            
+            self.__corner_masks[key] = mask
+            if len(self.__corner_masks) > CORNER_MASKS_CACHE_SIZE:
+                self.__corner_masks.popitem(last=False)
+        
         alpha = None
         if img.mode == 'RGBA':
             alpha = img.split()[3]
-
-        mask = Image.new('L', img.size, 255)
-        if top_left:
-            mask.paste(circle.crop((0, 0, rad, rad)), (0, 0))
-        if top_right:
-            mask.paste(circle.crop((rad, 0, rad * 2, rad)), (w - rad, 0))
-        if bottom_left:
-            mask.paste(circle.crop((0, rad, rad, rad * 2)), (0, h - rad))
-        if bottom_right:
-            mask.paste(circle.crop((rad, rad, rad * 2, rad * 2)), (w - rad, h - rad))
         
         if alpha:
             img.putalpha(ImageChops.multiply(alpha, mask))
@@ -322,159 +449,180 @@ class Quotes(commands.Cog):
             img.putalpha(mask)
         return img
 
-    def _add_gradient_dir(self, image: Image.Image, gradient_magnitude=1.0, color: Tuple[int, int, int]=(0, 0, 0), direction='bottom_to_top'):
-        width, height = image.size
-
-        gradient = Image.new('RGBA', (width, height), color)
-        draw = ImageDraw.Draw(gradient)
-
-        end_alpha = int(gradient_magnitude * 255)
-
-        if direction == 'top_to_bottom':
-            for y in range(height):
-                alpha = int((y / height) * end_alpha)
-                draw.line([(0, y), (width, y)], fill=(color[0], color[1], color[2], alpha))
-        elif direction == 'bottom_to_top':
-            for y in range(height, -1, -1):
-                alpha = int(((height - y) / height) * end_alpha)
-                draw.line([(0, y), (width, y)], fill=(color[0], color[1], color[2], alpha))
-        elif direction == 'left_to_right':
-            for x in range(width):
-                alpha = int((x / width) * end_alpha)
-                draw.line([(x, 0), (x, height)], fill=(color[0], color[1], color[2], alpha))
-        elif direction == 'right_to_left':
-            for x in range(width, -1, -1):
-                alpha = int(((width - x) / width) * end_alpha)
-                draw.line([(x, 0), (x, height)], fill=(color[0], color[1], color[2], alpha))
-
-        gradient_im = Image.alpha_composite(image.convert('RGBA'), gradient)
-        return gradient_im
+    def __get_overlay(self, size: Tuple[int, int], text_color: Tuple[int, int, int]) -> Image.Image:
+        """Récupère depuis le cache ou génère le calque transparent contenant l'icône et les lignes de séparation"""
+        key = (size[0], size[1], text_color)
+        if key not in self.__overlays:
+            w, h = size
+            overlay = Image.new('RGBA', size, (0, 0, 0, 0))
+            draw = ImageDraw.Draw(overlay)
+            icon = self.__assets['quotemark_white'] if text_color == (255, 255, 255) else self.__assets['quotemark_black']
+            icon_image = icon.resize((int(w * 0.06), int(w * 0.06)))
+            icon_left = w / 2 - icon_image.width / 2
+            overlay.alpha_composite(icon_image, dest=(int(icon_left), int(h * 0.85 - icon_image.height / 2)))
+            
+            draw.line((icon_left - w * 0.25, h * 0.85, icon_left - w * 0.02, h * 0.85), fill=text_color, width=1) # Ligne de gauche
+            draw.line((icon_left + icon_image.width + w * 0.02, h * 0.85, icon_left + icon_image.width + w * 0.25, h * 0.85), fill=text_color, width=1) # Ligne de droite
+            self.__overlays[key] = overlay
+        return self.__overlays[key]
+    
+    def _fit_text(self, draw: ImageDraw.ImageDraw, text: str, font_path: str, text_size: int, box_w: int, box_h: int, max_lines: int) -> Tuple[str, ImageFont.FreeTypeFont]:
+        """Découpe le texte et choisit la plus grande taille de police (au plus text_size) pour qu'il tienne dans la boîte"""
+        # La largeur des caractères étant proportionnelle à la taille de police, elle est estimée une fois sur un extrait (puis recalée par les mesures)
+        sample = text[:80]
+        char_width = max(self.__get_font(font_path, text_size).getlength(sample), 1) / max(len(sample), 1) / text_size # Largeur moyenne pour une taille de 1
+        
+        def wrap(size: int, wrap_width: int | None = None) -> Tuple[str, int]:
+            wrap_width = wrap_width or max(int(box_w / (char_width * size)), 1)
+            return textwrap.fill(text, width=wrap_width, max_lines=max_lines, placeholder="§"), wrap_width
+        
+        def may_fit(size: int) -> bool:
+            """Test sans mesure du texte : écarte les tailles dont le découpage estimé déborde forcément"""
+            lines, _ = wrap(size)
+            line_spacing = self.__get_line_spacing(font_path, size) + 0.25
+            return lines[-1] != "§" and lines.count('\n') * line_spacing <= box_h
+        
+        def fit(size: int) -> Optional[str]:
+            """Renvoie le texte découpé s'il tient réellement dans la boîte à cette taille"""
+            font = self.__get_font(font_path, size)
+            lines, wrap_width = wrap(size)
+            nonlocal char_width
+            while lines[-1] != "§":
+                width = max(font.getlength(line) for line in lines.split('\n'))
+                if width <= box_w:
+                    left, top, right, bottom = draw.multiline_textbbox((0, 0), lines, font=font, spacing=0.25)
+                    return lines if bottom - top <= box_h else None
+                if wrap_width <= 1:
+                    return None
+                # Certaines lignes sont plus larges que la moyenne : on resserre le retour à la ligne et on remesure
+                lines, wrap_width = wrap(size, min(wrap_width - 1, max(int(wrap_width * box_w / width), 1)))
+                char_width = max(char_width, box_w / (wrap_width * size)) # Estimation recalée pour les tailles suivantes
+            return None
+        
+        def largest(lo: int, hi: int, predicate) -> int:
+            """Recherche dichotomique de la plus grande taille de [lo, hi] vérifiant predicate (lo - 1 si aucune)"""
+            while lo <= hi:
+                mid = (lo + hi + 1) // 2
+                if predicate(mid):
+                    lo = mid + 1
+                else:
+                    hi = mid - 1
+            return hi
+        
+        results = {}
+        def fits(size: int) -> bool:
+            if size not in results:
+                results[size] = fit(size)
+            return results[size] is not None
+        
+        # Les tests sans mesure bornent la recherche : seules les tailles plausibles sont mesurées
+        hi = max(largest(2, text_size, may_fit), 2)
+        if not fits(hi):
+            # L'estimation a été recalée par la mesure : nouvelle borne, puis pas doublés jusqu'à une taille qui convient
+            failed, step = hi, 1
+            lo = max(min(largest(2, hi - 1, may_fit), hi - 1), 2)
+            while lo > 2 and not fits(lo):
+                failed, lo, step = lo, max(lo - step, 2), step * 2
+            if not fits(lo):
+                return wrap(2)[0], self.__get_font(font_path, 2)
+            # Recherche dichotomique de la plus grande taille qui convient entre la dernière réussite et le dernier échec
+            hi = largest(lo + 1, failed - 1, fits)
+        return results[hi], self.__get_font(font_path, hi)
     
     def create_quote_image(self, bg: Image.Image, bg_color: Tuple[int, int, int], text: str, author_name: str, channel_name: str, date: str, *, size: tuple[int, int] = (512, 512)):
         """Crée une image de citation avec un avatar, un texte, un nom d'auteur et une date."""
         text = text.upper()
 
         w, h = size
-        box_w, _ = int(w * 0.92), int(h * 0.72)
-        assets_path = self.data.get_folder('assets')
-        font_path = str(assets_path / "NotoBebasNeue.ttf")
+        box_w, box_h = int(w * 0.92), int(h * 0.72)
+        font_path = self.__font_paths['NotoBebasNeue']
         
-        image = copy.copy(bg)
+        image = bg.copy()
         luminosity = (0.2126 * bg_color[0] + 0.7152 * bg_color[1] + 0.0722 * bg_color[2]) / 255
 
         text_size = int(h * 0.08)
-        text_font = self.__get_font(font_path, text_size)
         draw = ImageDraw.Draw(image)
         text_color = (255, 255, 255) if luminosity < 0.5 else (0, 0, 0)
 
         # Texte principal --------
         max_lines = len(text) // 60 + 2 if len(text) > 200 else 4
-        wrap_width = int(box_w / (text_font.getlength("A") * 0.85))
-        lines = textwrap.fill(text, width=wrap_width, max_lines=max_lines, placeholder="§")
-        while lines[-1] == "§":
-            text_size -= 2
-            text_font = self.__get_font(font_path, text_size)
-            wrap_width = int(box_w / (text_font.getlength("A") * 0.85))
-            lines = textwrap.fill(text, width=wrap_width, max_lines=max_lines, placeholder="§")
+        lines, text_font = self._fit_text(draw, text, font_path, text_size, box_w, box_h, max_lines)
         draw.multiline_text((w / 2, h * 0.835), lines, font=text_font, spacing=0.25, align='center', fill=text_color, anchor='md')
 
         # Icone et lignes ---------
-        icon = self.__assets['quotemark_white'] if luminosity < 0.5 else self.__assets['quotemark_black']
-        icon_image = icon.resize((int(w * 0.06), int(w * 0.06)))
-        icon_left = w / 2 - icon_image.width / 2
-        image.paste(icon_image, (int(icon_left), int(h * 0.85 - icon_image.height / 2)), icon_image)
+        image.alpha_composite(self.__get_overlay(size, text_color))
 
         author_font = self.__get_font(font_path, int(h * 0.060))
         draw.text((w / 2,  h * 0.95), author_name, font=author_font, fill=text_color, anchor='md', align='center')
 
-        draw.line((icon_left - w * 0.25, h * 0.85, icon_left - w * 0.02, h * 0.85), fill=text_color, width=1) # Ligne de gauche
-        draw.line((icon_left + icon_image.width + w * 0.02, h * 0.85, icon_left + icon_image.width + w * 0.25, h * 0.85), fill=text_color, width=1) # Ligne de droite
-
         # Date -------------------
         date_font = self.__get_font(font_path, int(h * 0.040))
         date_text = f"#{channel_name} • {date}"
         draw.text((w / 2, h * 0.9875), date_text, font=date_font, fill=text_color, anchor='md', align='center')
         return image
     
+    def _render_group(self, author: discord.User | discord.Member, full_text: str, bg: Image.Image, avatar: Image.Image, size: Tuple[int, int],
+                      fonts: Tuple[ImageFont.FreeTypeFont, ImageFont.FreeTypeFont, ImageFont.FreeTypeFont]) -> Image.Image:
+        """Génère l'image d'un groupe de messages consécutifs d'un même auteur"""
+        ggsans, ggsans_xs, ggsans_semi = fonts
+        img = Image.new('RGB', size, (255, 255, 255))
+        draw = ImageDraw.Draw(img)
+        text_color = (255, 255, 255)
+        
+        # On ajoute le fond flouté et l'avatar arrondi à gauche
+        img.paste(bg, (0, 0))
+        img.paste(avatar, (40, 40), avatar)
+        
+        # On ajoute le nom de l'auteur
+        if author.display_name.lower() == author.name.lower():
+            draw.text((180, 30), author.display_name, text_color, font=ggsans)
+        else:
+            draw.text((180, 30), author.display_name, text_color, font=ggsans)
+            draw.text((180 + ggsans.getlength(author.display_name) + 10, 44), f"@{author.name}", (text_color[0], text_color[1], text_color[2], 220), font=ggsans_xs)
+        
+        # On ajoute le texte en dessous
+        draw.multiline_text((180, 80), full_text, text_color, font=ggsans_semi)
+        return img
+    
     async def _generate_multiple_quote(self, messages: list[discord.Message]) -> Image.Image:
         """Génère une image avec plusieurs citations."""
         width = 1000
         
-        assets_path = self.data.get_folder('assets')
         # Fonts
-        ggsans = self.__get_font(str(assets_path / "gg_sans.ttf"), 40)
-        ggsans_xs = self.__get_font(str(assets_path / "gg_sans.ttf"), 24)
-        ggsans_semi = self.__get_font(str(assets_path / "gg_sans_semi.ttf"), 32)
+        ggsans = self.__get_font(self.__font_paths['gg_sans'], 40)
+        ggsans_xs = self.__get_font(self.__font_paths['gg_sans'], 24)
+        ggsans_semi = self.__get_font(self.__font_paths['gg_sans_semi'], 32)
+        fonts = (ggsans, ggsans_xs, ggsans_semi)
         
         # On commence par regrouper les messages par auteur
-        regrouped_messages = {} # On regroupe les messages qui se suivent avec le même auteur
+        regrouped_messages : list[list[discord.Message]] = [] # On regroupe les messages qui se suivent avec le même auteur
         current_author = None
-        group = 0
         for msg in messages:
             if msg.author != current_author:
-                group += 1
                 current_author = msg.author
-                regrouped_messages[group] = []
-            regrouped_messages[group].append(msg)
+                regrouped_messages.append([])
+            regrouped_messages[-1].append(msg)
                 
-        # On génère les images
-        images = []
-        total_height = 0
-        for _, msgs in regrouped_messages.items():
-            full_text = ''
+        # On prépare le texte et la hauteur de chaque groupe
+        groups = []
+        for msgs in regrouped_messages:
+            lines = []
             for msg in msgs:
                 content = self.normalize_text(msg.clean_content)
-                if len(content) > 50:
-                    content = '\n'.join(textwrap.wrap(content, 50))
-                full_text += f"{content}\n"
-            full_text = full_text[:-1]
+                lines.extend(textwrap.wrap(content, 50) if len(content) > 50 else content.split('\n'))
+            full_text = '\n'.join(lines)
             
             # On détermine la hauteur en fonction du nombre de lignes
             base_height = 200
-            height = base_height + 40 * (full_text.count('\n') - 1 if full_text.count('\n') > 0 else 0)
-            # On génère l'image
-            img = Image.new('RGB', (width, height), (255, 255, 255))
-            draw = ImageDraw.Draw(img)
-            
-            # On ajoute le fond avec cv2 (on crop l'avatar avec pillow avant)
-            disp_avatar = BytesIO(await msgs[0].author.display_avatar.read())
-            disp_avatar = Image.open(disp_avatar).convert('RGBA')
-            
-            bg = copy.copy(disp_avatar)
-            text_color = (255, 255, 255)
-            
-            bg = bg.resize((width, width))
-            if bg.height > height:
-                # On crop pour avoir height en hauteur (milieu de l'image)
-                bg = bg.crop((0, (bg.height - height) // 2, bg.width, (bg.height - height) // 2 + height))
-            elif bg.height < height:
-                # On resize pour avoir height en hauteur (milieu de l'image)
-                bg = bg.resize((height, height), Image.LANCZOS)
-                bg = bg.crop(((bg.width - width) // 2, 0, (bg.width - width) // 2 + width, bg.height))
-            bg = cv2.GaussianBlur(np.array(bg), (115, 115), 0)
-            bg = Image.fromarray(bg)
-            bg = self._add_gradient_dir(bg, 0.9, direction='right_to_left')
-            img.paste(bg, (0, 0))
-            
-            # On ajoute l'avatar arrondi à gauche
-            
-            avatar = disp_avatar.resize((240, 240))
-            avatar = self._round_corners(avatar, 30)
-            avatar = avatar.resize((120, 120), Image.LANCZOS)
-            img.paste(avatar, (40, 40), avatar)
-            
-            # On ajoute le nom de l'auteur
-            if msgs[0].author.display_name.lower() == msgs[0].author.name.lower():
-                draw.text((180, 30), msgs[0].author.display_name, text_color, font=ggsans)
-            else:
-                draw.text((180, 30), msgs[0].author.display_name, text_color, font=ggsans)
-                draw.text((180 + ggsans.getlength(msgs[0].author.display_name) + 10, 44), f"@{msgs[0].author.name}", (text_color[0], text_color[1], text_color[2], 220), font=ggsans_xs)
-            
-            # On ajoute le texte en dessous
-            draw.multiline_text((180, 80), full_text, text_color, font=ggsans_semi)
-            
-            total_height += height
-            images.append(img)
+            height = base_height + 40 * max(len(lines) - 2, 0)
+            groups.append((msgs[0].author, full_text, height))
+        
+        # On génère les images (téléchargements puis rendus en parallèle)
+        backgrounds = await self._get_blurred_bgs([(author, height) for author, _, height in groups], width)
+        loop = asyncio.get_running_loop()
+        images = await asyncio.gather(*[loop.run_in_executor(None, self._render_group, author, full_text, bg, avatar, (width, height), fonts)
+                                        for (author, full_text, height), (bg, avatar) in zip(groups, backgrounds)])
+        total_height = sum(img.height for img in images)
 
         # On concatène les images
         final_img = Image.new('RGBA', (width, total_height), (0, 0, 0, 0))
@@ -489,7 +637,7 @@ class Quotes(commands.Cog):
         """Ajoute au message initial les messages suivants jusqu'à atteindre la limite de caractères ou de messages"""
         messages = [starting_message]
         total_length = len(starting_message.content)
-        async for message in starting_message.channel.history(limit=15, after=starting_message):
+        async for message in starting_message.channel.history(limit=messages_limit + 3, after=starting_message, oldest_first=True):
             if not message.content or message.content.isspace():
                 continue
             if message.author != starting_message.author:
@@ -505,19 +653,18 @@ class Quotes(commands.Cog):
     async def fetch_following_messages_multiple_authors(self, starting_message: discord.Message, messages_limit: int = 10) -> list[discord.Message]:
         """Ajoute au message initial les messages autour jusqu'à atteindre la limite de messages"""
         messages = []
-        async for message in starting_message.channel.history(limit=messages_limit, after=starting_message):
+        async for message in starting_message.channel.history(limit=messages_limit, after=starting_message, oldest_first=True):
             if not message.content or message.content.isspace():
                 continue
             messages.append(message)
         return messages
     
     async def generate_quote_from(self, messages: list[discord.Message]) -> discord.File:
-        messages = sorted(messages, key=lambda m: m.created_at)
+        """Génère l'image de citation d'une suite de messages (dans l'ordre chronologique)"""
         base_message = messages[0]
         if not isinstance(base_message.author, discord.Member):
             raise ValueError("Le message de base doit être envoyé par un membre du serveur.")
         
-        precal = await self.__get_background(base_message.author)
         message_date = messages[0].created_at.strftime("%d.%m.%Y")
         if isinstance(messages[0].channel, (discord.DMChannel, discord.PartialMessageable)):
             message_channel_name = 'MP'
@@ -525,21 +672,29 @@ class Quotes(commands.Cog):
             message_channel_name = messages[0].channel.name if messages[0].channel.name else 'Inconnu'
         full_content = ' '.join([self.normalize_text(m.content) for m in messages])
         author_name = f"@{base_message.author.name}" if not base_message.author.nick else f"{base_message.author.nick} (@{base_message.author.name})"
+        alt_text = pretty.shorten_text(full_content, 950)
+        alt_text = f"\"{alt_text}\" - {author_name} [#{message_channel_name} • {message_date}]"
+        
+        # Les mêmes sélections reviennent souvent lorsque l'utilisateur modifie le menu déroulant
+        cache_key = (full_content, author_name, message_channel_name, message_date, base_message.author.id, base_message.author.display_avatar.key)
+        if cache_key in self.__quote_png_cache:
+            self.__quote_png_cache.move_to_end(cache_key)
+            return discord.File(BytesIO(self.__quote_png_cache[cache_key]), filename='quote.png', description=alt_text)
+        
+        precal = await self.__get_background(base_message.author)
         try:
-            image = self.create_quote_image(precal[0], precal[1], full_content, author_name, message_channel_name, message_date, size=DEFAULT_QUOTE_IMAGE_SIZE)
+            # Le rendu et l'encodage sont effectués dans un thread pour ne pas bloquer la boucle d'événements
+            image = await asyncio.to_thread(self.create_quote_image, precal[0], precal[1], full_content, author_name, message_channel_name, message_date, size=DEFAULT_QUOTE_IMAGE_SIZE)
         except Exception as e:
             logger.exception(e, exc_info=True)
             raise ValueError("Impossible de générer l'image de citation.")
         
-        with BytesIO() as buffer:
-            image.save(buffer, format='PNG')
-            buffer.seek(0)
-            alt_text = pretty.shorten_text(full_content, 950)
-            alt_text = f"\"{alt_text}\" - {author_name} [#{message_channel_name} • {message_date}]"
-            return discord.File(buffer, filename='quote.png', description=alt_text)
+        buffer = await asyncio.to_thread(self._encode_png, image)
+        self.__cache_quote_png(cache_key, buffer.getvalue())
+        return discord.File(buffer, filename='quote.png', description=alt_text)
         
     async def generate_multiple_quote_from(self, messages: list[discord.Message]) -> discord.File:
-        messages = sorted(messages, key=lambda m: m.created_at)
+        """Génère l'image combinant plusieurs messages (dans l'ordre chronologique)"""
         base_message = messages[0]
         if not isinstance(base_message.author, discord.Member):
             raise ValueError("Le message de base doit être envoyé par un membre du serveur.")
@@ -550,16 +705,54 @@ class Quotes(commands.Cog):
             logger.exception(e, exc_info=True)
             raise ValueError("Impossible de générer l'image de citation.")
         
-        with BytesIO() as buffer:
-            image.save(buffer, format='PNG')
-            buffer.seek(0)
-            return discord.File(buffer, filename='multiple_quote.png', description="Citation multiple de " + ', '.join([a.name for a in authors]))
+        buffer = await asyncio.to_thread(self._encode_png, image)
+        return discord.File(buffer, filename='multiple_quote.png', description="Citation multiple de " + ', '.join([a.name for a in authors]))
+    
+    def __cache_quote_png(self, key: tuple, data: bytes) -> None:
+        """Garde une citation générée en cache, limité en nombre d'entrées et en taille totale"""
+        previous = self.__quote_png_cache.pop(key, None)
+        if previous is not None:
+            self.__quote_png_cache_bytes -= len(previous)
+        self.__quote_png_cache[key] = data
+        self.__quote_png_cache_bytes += len(data)
+        while len(self.__quote_png_cache) > QUOTE_PNG_CACHE_SIZE or self.__quote_png_cache_bytes > QUOTE_PNG_CACHE_MAX_BYTES:
+            _, evicted = self.__quote_png_cache.popitem(last=False)
+            self.__quote_png_cache_bytes -= len(evicted)
+    
+    def _encode_png(self, image: Image.Image) -> BytesIO:
+        """Encode une image en PNG avec une compression rapide (le buffer est ensuite possédé par discord.File)"""
+        buffer = BytesIO()
+        image.save(buffer, format='PNG', compress_level=1, optimize=False)
+        buffer.seek(0)
+        return buffer
     
     def normalize_text(self, text: str) -> str:
         """Effectue des remplacements de texte pour éviter les problèmes d'affichage"""
-        text = re.sub(r'<a?:(\w+):\d+>', r':\1:', text)
-        text = re.sub(r'(\*|_|`|~|\\)', r'', text)
-        return text
+        return CUSTOM_EMOJI_REGEX.sub(r':\1:', text).translate(MARKDOWN_STRIP_TABLE)
+    
+    # Inspirobot ----------------------------------------------------------------
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Renvoie la session HTTP partagée, créée à la première utilisation (le cog peut être chargé après on_ready)"""
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+        return self._http
+    
+    async def fetch_inspirobot_url(self) -> Optional[str]:
+        """Demande à Inspirobot.me de générer une nouvelle citation et renvoie l'URL de son image"""
+        async with self._get_session().get(INSPIROBOT_API_URL) as resp:
+            if resp.status != 200:
+                return None
+            return await resp.text()
+    
+    @tasks.loop(minutes=5)
+    async def prefetch_inspirobot(self):
+        """Garde quelques URLs de citations Inspirobot prêtes pour que la commande n'ait plus qu'une image à télécharger"""
+        while not self._inspirobot_urls.full():
+            url = await self.fetch_inspirobot_url()
+            if url is None:
+                break
+            self._inspirobot_urls.put_nowait(url)
     
     # COMMANDES =================================================================
     
@@ -569,22 +762,17 @@ class Quotes(commands.Cog):
         """Obtenir une citation aléatoire de Inspirobot.me"""
         await interaction.response.defer()
         
-        async def get_inspirobot_quote():
-            async with aiohttp.ClientSession() as session:
-                async with session.get('https://inspirobot.me/api?generate=true') as resp:
-                    if resp.status != 200:
-                        return None
-                    return await resp.text()
-                
-        url = await get_inspirobot_quote()
+        try:
+            url = self._inspirobot_urls.get_nowait()
+        except asyncio.QueueEmpty:
+            url = await self.fetch_inspirobot_url()
         if url is None:
             return await interaction.followup.send("**Erreur** • Impossible d'obtenir une citation depuis Inspirobot.me.", ephemeral=True)
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp.status != 200:
-                    return await interaction.followup.send("**Erreur** • Impossible d'obtenir une citation depuis Inspirobot.me.", ephemeral=True)
-                data = BytesIO(await resp.read())
+        async with self._get_session().get(url) as resp:
+            if resp.status != 200:
+                return await interaction.followup.send("**Erreur** • Impossible d'obtenir une citation depuis Inspirobot.me.", ephemeral=True)
+            data = BytesIO(await resp.read())
         
         await interaction.followup.send(file=discord.File(data, 'quote.png', description="Citation fournie par Inspirobot.me"))
         
@@ -623,9 +811,12 @@ class Quotes(commands.Cog):
         
     @commands.Cog.listener()
     async def on_member_update(self, before: discord.Member, after: discord.Member):
-        if before.id in self.__backgrounds:
-            if before.display_avatar != after.display_avatar:
-                del self.__backgrounds[before.id]
+        if before.display_avatar == after.display_avatar:
+            return
+        for key in [k for k in self.__backgrounds if k[0] == before.id]:
+            del self.__backgrounds[key]
+        for key in [k for k in self.__mq_backgrounds if k[0] == before.id]:
+            del self.__mq_backgrounds[key]
 
 async def setup(bot):
     await bot.add_cog(Quotes(bot))
@@ -1,10 +1,11 @@
 from imaplib import Commands
 import logging
-from datetime import datetime, timedelta
+import sqlite3
+import time
 
 import discord
 from discord import Interaction, app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 from common import dataio
 
@@ -32,7 +33,7 @@ class SendModal(discord.ui.Modal):
     async def on_submit(self, interaction: discord.Interaction) -> None:
         msg = self.message_content.value
         if self.signature.value:
-            if discord.utils.find(lambda m: m.name.lower() == self.signature.value.lower(), self.__cog.bot.users):
+            if self.__cog.is_username_taken(self.signature.value):
                 return await interaction.response.send_message("**Erreur** • Vous ne pouvez pas signer avec un pseudo existant.", ephemeral=True)
             msg += f"\n\n— *Message anonyme signé **{self.signature.value}***"
         else:
@@ -44,8 +45,8 @@ class SendModal(discord.ui.Modal):
         else:
             await interaction.response.send_message(f"**Message envoyé** • Votre message `#{sended.id}` a été envoyé à {self.receiver.mention}.", ephemeral=True)
             self.__cog.add_tracking(sended, interaction.user)
-            self.__cog._cooldowns[(interaction.user.id, self.receiver.id)] = datetime.now() + timedelta(seconds=COOLDOWN_DELAY)
-            logger.info(f"Message anonyme envoyé par {interaction.user} à {self.receiver} le {datetime.now().strftime('%d/%m/%Y %H:%M:%S')})")
+            self.__cog._cooldowns[(interaction.user.id, self.receiver.id)] = time.monotonic() + COOLDOWN_DELAY
+            logger.info("Message anonyme envoyé par %s à %s", interaction.user, self.receiver)
 
 class Secrets(commands.Cog):
     """Envoi et réception de messages anonymes."""
@@ -67,27 +68,71 @@ class Secrets(commands.Cog):
                 sender_id INTEGER
                 )"""
         )
-        # Blacklistes d'utilisateurs
+        # Blacklistes d'utilisateurs (une ligne par utilisateur bloqué)
         blacklist = dataio.TableInitializer(
-            table_name="blacklist",
-            create_query="""CREATE TABLE IF NOT EXISTS blacklist (
-                owner_id INTEGER PRIMARY KEY,
-                blocked_ids TEXT
+            table_name="blacklist_entries",
+            create_query="""CREATE TABLE IF NOT EXISTS blacklist_entries (
+                owner_id INTEGER,
+                blocked_id INTEGER,
+                PRIMARY KEY (owner_id, blocked_id)
                 )"""
         )
         self.data.append_initializers_for("global", [tracking, blacklist])
         
+        # WAL : les écritures fréquentes (tracking, blacklists) n'imposent plus une synchronisation complète à chaque commit
+        self.__db = self.data.get('global') # Base commune, ouverte une seule fois
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS idx_tracking_sender ON tracking(sender_id)")
+        
+        self.__migrate_blacklists()
+        self.__blacklists : dict[int, set[int]] = self.__load_blacklists() # Blacklists en mémoire (propriétaire -> utilisateurs bloqués)
+        
         self.anonymous_ctx = app_commands.ContextMenu(
             name='Envoyer anonymement',
             callback=self.send_anonymous_message,
             extras={'description': "Envoie un message anonyme à l'utilisateur visé."})
         self.bot.tree.add_command(self.anonymous_ctx)
         
-        self._cooldowns : dict[tuple[int, int], datetime] = {}
+        self._cooldowns : dict[tuple[int, int], float] = {} # Fin des cooldowns (horloge monotone)
+        
+        self.__pending_tracking : dict[int, int] = {} # Messages envoyés pas encore enregistrés (message -> auteur)
+        self.__tracking_count : int = self.__db.fetchone("SELECT COUNT(*) AS c FROM tracking")['c'] # Nombre total de messages envoyés
+        self.flush_tracking.start()
+        self.clean_cooldowns.start()
+        
+        self.__usernames : set[str] = {u.name.casefold() for u in bot.users} # Pseudos connus, pour refuser les signatures usurpées
     
     def cog_unload(self):
+        self.flush_tracking.cancel()
+        self.clean_cooldowns.cancel()
+        self.__flush_tracking()
+        if self.__pending_tracking:
+            logger.error("%d messages anonymes n'ont pas pu être enregistrés avant le déchargement", len(self.__pending_tracking))
         self.data.close_all()
         
+    @commands.Cog.listener()
+    async def on_ready(self):
+        self.__usernames = {u.name.casefold() for u in self.bot.users}
+        
+    @commands.Cog.listener()
+    async def on_user_update(self, before: discord.User, after: discord.User):
+        if before.name != after.name:
+            self.__usernames.discard(before.name.casefold())
+            self.__usernames.add(after.name.casefold())
+            
+    @commands.Cog.listener()
+    async def on_member_join(self, member: discord.Member):
+        self.__usernames.add(member.name.casefold())
+        
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild: discord.Guild):
+        self.__usernames.update(m.name.casefold() for m in guild.members)
+        
+    def is_username_taken(self, name: str) -> bool:
+        """Vérifie si un pseudo appartient à un utilisateur connu du bot."""
+        return name.casefold() in self.__usernames
+        
     # Settings ----------------------------------------------------------------
     
     def get_restrict_role(self, guild: discord.Guild) -> discord.Role | None:
@@ -104,45 +149,87 @@ class Secrets(commands.Cog):
     # Tracking ----------------------------------------------------------------
     
     def add_tracking(self, message: discord.Message, sender: discord.User | discord.Member):
-        """Ajoute un message à la table de tracking."""
-        self.data.get('global').execute("INSERT INTO tracking VALUES (?, ?)", (message.id, sender.id))
+        """Ajoute un message à la table de tracking (enregistré par lots)."""
+        self.__pending_tracking[message.id] = sender.id
+        self.__tracking_count += 1
         
     def get_tracking(self, message_id: int) -> int | None:
         """Renvoie l'utilisateur ayant envoyé le message."""
-        r = self.data.get('global').fetchone("SELECT sender_id FROM tracking WHERE message_id = ?", (message_id,))
+        sender_id = self.__pending_tracking.get(message_id)
+        if sender_id:
+            return sender_id
+        r = self.__db.fetchone("SELECT sender_id FROM tracking WHERE message_id = ?", (message_id,))
         if r:
             return r['sender_id']
         return None
     
+    @tasks.loop(seconds=5)
+    async def flush_tracking(self):
+        """Enregistre les messages envoyés depuis le dernier passage."""
+        self.__flush_tracking()
+        
+    def __flush_tracking(self):
+        if not self.__pending_tracking:
+            return
+        batch, self.__pending_tracking = self.__pending_tracking, {}
+        try:
+            self.__db.executemany("INSERT INTO tracking VALUES (?, ?)", list(batch.items()))
+        except sqlite3.Error:
+            # On remet le lot en attente pour le prochain passage plutôt que de le perdre (et d'arrêter la boucle)
+            logger.exception("Impossible d'enregistrer %d messages anonymes, nouvel essai au prochain passage", len(batch))
+            self.__db.rollback()
+            batch.update(self.__pending_tracking)
+            self.__pending_tracking = batch
+    
+    # Cooldowns ----------------------------------------------------------------
+    
+    @tasks.loop(hours=1)
+    async def clean_cooldowns(self):
+        """Retire les cooldowns expirés."""
+        now = time.monotonic()
+        self._cooldowns = {k: v for k, v in self._cooldowns.items() if v > now}
+    
     # Blacklist ----------------------------------------------------------------
     
+    def __migrate_blacklists(self):
+        """Convertit l'ancienne table blacklist (identifiants séparés par des virgules) vers blacklist_entries."""
+        if 'blacklist' not in self.__db.tables:
+            return
+        rows = self.__db.fetchall("SELECT owner_id, blocked_ids FROM blacklist")
+        entries = [(row['owner_id'], int(blocked_id)) for row in rows if row['blocked_ids'] for blocked_id in row['blocked_ids'].split(',')]
+        self.__db.executemany("INSERT OR IGNORE INTO blacklist_entries VALUES (?, ?)", entries, commit=False)
+        self.__db.execute("DROP TABLE blacklist")
+        logger.info(f"{len(entries)} entrées de blacklist migrées vers la table blacklist_entries")
+    
+    def __load_blacklists(self) -> dict[int, set[int]]:
+        """Charge en une seule requête l'ensemble des blacklists en mémoire."""
+        blacklists = {}
+        for row in self.__db.fetchall("SELECT owner_id, blocked_id FROM blacklist_entries"):
+            blacklists.setdefault(row['owner_id'], set()).add(row['blocked_id'])
+        return blacklists
+    
     def add_blacklist(self, owner: discord.User | discord.Member, blocked: discord.User | discord.Member):
         """Ajoute un utilisateur à la blacklist d'un autre."""
-        blocked_ids = self.data.get('global').fetchone("SELECT blocked_ids FROM blacklist WHERE owner_id = ?", (owner.id,))
-        if blocked_ids:
-            blocked_ids = set(map(int, blocked_ids['blocked_ids'].split(',') if blocked_ids['blocked_ids'] else []))
-        else:
-            blocked_ids = set()
-        blocked_ids.add(blocked.id)
-        self.data.get('global').execute("INSERT OR REPLACE INTO blacklist VALUES (?, ?)", (owner.id, ",".join(map(str, blocked_ids))))
+        self.__blacklists.setdefault(owner.id, set()).add(blocked.id)
+        self.__db.execute("INSERT OR IGNORE INTO blacklist_entries VALUES (?, ?)", (owner.id, blocked.id))
         
     def remove_blacklist(self, owner: discord.User | discord.Member, blocked: discord.User | discord.Member):
         """Retire un utilisateur de la blacklist d'un autre."""
-        blocked_ids = self.data.get('global').fetchone("SELECT blocked_ids FROM blacklist WHERE owner_id = ?", (owner.id,))
-        if blocked_ids:
-            blocked_ids = set(map(int, blocked_ids['blocked_ids'].split(',')))
-            blocked_ids.discard(blocked.id)
-            if blocked_ids:
-                self.data.get('global').execute("INSERT OR REPLACE INTO blacklist VALUES (?, ?)", (owner.id, ",".join(map(str, blocked_ids))))
-            else:
-                self.data.get('global').execute("DELETE FROM blacklist WHERE owner_id = ?", (owner.id,))
+        blocked_ids = self.__blacklists.get(owner.id)
+        if not blocked_ids or blocked.id not in blocked_ids:
+            return
+        blocked_ids.discard(blocked.id)
+        if not blocked_ids:
+            del self.__blacklists[owner.id]
+        self.__db.execute("DELETE FROM blacklist_entries WHERE owner_id = ? AND blocked_id = ?", (owner.id, blocked.id))
             
     def get_blacklist(self, owner: discord.User | discord.Member) -> set[int]:
         """Renvoie la liste des utilisateurs bloqués par un autre."""
-        blocked_ids = self.data.get('global').fetchone("SELECT blocked_ids FROM blacklist WHERE owner_id = ?", (owner.id,))
-        if blocked_ids:
-            return set(map(int, blocked_ids['blocked_ids'].split(',')))
-        return set()
+        return set(self.__blacklists.get(owner.id, ()))
+    
+    def is_blacklisted(self, owner: discord.User | discord.Member, user_id: int) -> bool:
+        """Vérifie si un utilisateur est bloqué par un autre, sans copier sa blacklist."""
+        return user_id in self.__blacklists.get(owner.id, ())
         
     async def send_anonymous_message(self, interaction: Interaction, user: discord.User | discord.Member):
         """Envoie un message anonymisé en MP à un utilisateur."""
@@ -151,19 +238,32 @@ class Secrets(commands.Cog):
             return await interaction.response.send_message(f"**Impossible** • Vous ne pouvez pas vous envoyer de message à vous-même.", ephemeral=True)
         if user.bot:
             return await interaction.response.send_message(f"**Impossible** • Vous ne pouvez pas envoyer de message à un bot.", ephemeral=True)
+        cd_key = (author.id, user.id)
+        cd = self._cooldowns.get(cd_key)
+        if cd:
+            now = time.monotonic()
+            if now < cd:
+                return await interaction.response.send_message(f"**Cooldown** • Vous devez attendre <t:{int(time.time() + cd - now)}:t> pour renvoyer au même utilisateur.", ephemeral=True)
+            del self._cooldowns[cd_key]
+        if self.is_blacklisted(user, author.id):
+            return await interaction.response.send_message(f"**Impossible** • Cet utilisateur a bloqué un de vos messages, vous ne pouvez donc plus lui en envoyer.", ephemeral=True)
+        # Seule vérification nécessitant une requête : en dernier
         if isinstance(author, discord.Member) and interaction.guild:
             restrict_role = self.get_restrict_role(interaction.guild)
             if restrict_role and restrict_role not in author.roles:
                 return await interaction.response.send_message(f"**Impossible** • Vous devez avoir le rôle {restrict_role.mention} pour envoyer des messages anonymes.", ephemeral=True)
-        if author.id in self.get_blacklist(user):
-            return await interaction.response.send_message(f"**Impossible** • Cet utilisateur a bloqué un de vos messages, vous ne pouvez donc plus lui en envoyer.", ephemeral=True)
-        cd = self._cooldowns.get((author.id, user.id))
-        if cd and datetime.now() < cd:
-            return await interaction.response.send_message(f"**Cooldown** • Vous devez attendre {cd.strftime('%Hh%M')} pour renvoyer au même utilisateur.", ephemeral=True)
         
         modal = SendModal(self, user)
         await interaction.response.send_modal(modal)
         
+    async def _resolve_message_id(self, interaction: Interaction, message_id: str) -> int | None:
+        """Convertit l'identifiant de message fourni en entier, ou répond avec une erreur s'il est invalide."""
+        message_id = message_id.strip()
+        if not message_id.isdecimal():
+            await interaction.response.send_message(f"**Erreur** • L'identifiant du message doit être un nombre.", ephemeral=True)
+            return None
+        return int(message_id)
+        
     # COMMANDES ----------------------------------------------------------------
     
     secrets_group = app_commands.Group(name='secrets', description="Commandes liées aux messages anonymes.")
@@ -173,18 +273,16 @@ class Secrets(commands.Cog):
         """Bloque un utilisateur pour ne plus recevoir de messages anonymes de sa part.
         
         :param message_id: L'identifiant du message dont il faut bloquer l'auteur"""
-        try:
-            msg_id = int(message_id)
-        except ValueError:
-            return await interaction.response.send_message(f"**Erreur** • L'identifiant du message doit être un nombre.", ephemeral=True)
+        msg_id = await self._resolve_message_id(interaction, message_id)
+        if msg_id is None:
+            return
         sender_id = self.get_tracking(msg_id)
         if sender_id:
             sender = self.bot.get_user(sender_id)
             if not sender:
                 return await interaction.response.send_message(f"**Erreur** • L'utilisateur concerné n'est pas joignable.", ephemeral=True)
                 
-            blacklist = self.get_blacklist(interaction.user)
-            if sender.id in blacklist:
+            if self.is_blacklisted(interaction.user, sender.id):
                 await interaction.response.send_message(f"**Utilisateur bloqué** • Vous avez déjà bloqué l'auteur de ce message.", ephemeral=True)
             else:
                 self.add_blacklist(interaction.user, sender)
@@ -195,18 +293,16 @@ class Secrets(commands.Cog):
         """Débloque un utilisateur pour recevoir de nouveau des messages anonymes de sa part.
         
         :param message_id: L'identifiant du message dont il faut débloquer l'auteur"""
-        try:
-            msg_id = int(message_id)
-        except ValueError:
-            return await interaction.response.send_message(f"**Erreur** • L'identifiant du message doit être un nombre.", ephemeral=True)
+        msg_id = await self._resolve_message_id(interaction, message_id)
+        if msg_id is None:
+            return
         sender_id = self.get_tracking(msg_id)
         if sender_id:
             sender = self.bot.get_user(sender_id)
             if not sender:
                 return await interaction.response.send_message(f"**Erreur** • L'utilisateur concerné n'est pas joignable.", ephemeral=True)
                 
-            blacklist = self.get_blacklist(interaction.user)
-            if sender.id in blacklist:
+            if self.is_blacklisted(interaction.user, sender.id):
                 self.remove_blacklist(interaction.user, sender)
                 await interaction.response.send_message(f"**Utilisateur débloqué** • Vous pouvez de nouveau recevoir des messages anonymes de la part de l'auteur de ce message.", ephemeral=True)
             else:
@@ -215,9 +311,7 @@ class Secrets(commands.Cog):
     @secrets_group.command(name='stats')
     async def stats(self, interaction: Interaction):
         """Renvoie des statistiques sur les messages anonymes."""
-        r = self.data.get('global').fetchone("SELECT COUNT(*) FROM tracking")
-        total = r['COUNT(*)'] if r else 0
-        await interaction.response.send_message(f"**Statistiques** • {total} messages anonymes ont été envoyés depuis le début.", ephemeral=True)
+        await interaction.response.send_message(f"**Statistiques** • {self.__tracking_count} messages anonymes ont été envoyés depuis le début.", ephemeral=True)
     
     settings_group = app_commands.Group(name='config-secrets', description="Commandes d'administration des messages anonymes.", default_permissions=discord.Permissions(administrator=True))
     
@@ -226,10 +320,9 @@ class Secrets(commands.Cog):
         """Révèle l'auteur d'un message anonyme.
         
         :param message_id: L'identifiant du message à révéler"""  
-        try:
-            msg_id = int(message_id)
-        except ValueError:
-            return await interaction.response.send_message(f"**Erreur** • L'identifiant du message doit être un nombre.", ephemeral=True)   
+        msg_id = await self._resolve_message_id(interaction, message_id)
+        if msg_id is None:
+            return
         sender_id = self.get_tracking(msg_id)
         if sender_id:
             sender = self.bot.get_user(sender_id)
@@ -1,6 +1,9 @@
 import asyncio
 import logging
 import re
+import string
+from collections import OrderedDict
+from urllib.parse import urlsplit
 
 import discord
 from discord import Interaction, app_commands
@@ -21,9 +24,14 @@ DEFAULT_TRIGGERS = [
     {'label': 'reddit.com', 'search': 'https://www.reddit.com/', 'replace': 'https://www.rxddit.com/'}
      ]
 
+TRIGGERS_CACHE_SIZE = 512
+
+URL_REGEX = re.compile(r'(?<!\\)(https?://\S+)') # On exclut les liens précédés de \
+DOMAIN_CHARS = frozenset(string.ascii_letters + string.digits + '-.')
+
 class CancelButtonView(discord.ui.View):
     """Ajoute un bouton permettant d'annuler la preview et restaurer celle du message original"""
-    def __init__(self, link_message: discord.Message, replace_message: discord.Message, *, timeout: float | None = 7):
+    def __init__(self, link_message: discord.Message, replace_message: discord.Message | None = None, *, timeout: float | None = 7):
         super().__init__(timeout=timeout)
         self.link_msg = link_message
         self.replace_msg = replace_message
@@ -75,11 +83,29 @@ class WebUtils(commands.Cog):
         
         # TODO: Historique des liens postés
         
-        self.__triggers_cache = {}
+        self.__settings_cache : dict[int, dict[str, bool]] = {}
+        self.__triggers_cache : OrderedDict[int, list[dict]] = OrderedDict()
+        self.__labels_cache : dict[int, tuple[str, ...]] = {} # Labels des déclencheurs (autocomplétion)
+        self.__patterns_cache : OrderedDict[int, tuple[re.Pattern | None, list[tuple[re.Pattern, str, str | None]]]] = OrderedDict() # Déclencheurs compilés (motif combiné, (motif, remplacement, littéral requis))
         
     def cog_unload(self):
         self.data.close_all()
     
+    # Paramètres ---------------------------------------------------------------
+    
+    def get_setting(self, guild: discord.Guild, key: str) -> bool:
+        """Renvoie la valeur d'un paramètre du serveur (mis en cache)"""
+        if guild.id not in self.__settings_cache:
+            values = self.data.get_collection_values(guild, 'settings')
+            self.__settings_cache[guild.id] = {k: bool(int(v)) for k, v in values.items()}
+        return self.__settings_cache[guild.id].get(key, False)
+    
+    def set_setting(self, guild: discord.Guild, key: str, value: bool):
+        """Modifie la valeur d'un paramètre du serveur"""
+        self.data.set_keyvalue_table_value(guild, 'settings', key, int(value))
+        if guild.id in self.__settings_cache:
+            self.__settings_cache[guild.id][key] = value
+    
     # Gestion des déclencheurs ---------------------------------------------------------------
     
     def get_triggers(self, guild: discord.Guild) -> list[dict]:
@@ -95,35 +121,119 @@ class WebUtils(commands.Cog):
     def set_trigger(self, guild: discord.Guild, label: str, search: str, replace: str):
         """Ajoute un déclencheur pour le serveur"""
         self.data.get(guild).execute("INSERT OR REPLACE INTO link_fixes VALUES (?, ?, ?)", (label, search, replace))
+        # On modifie directement le cache plutôt que de relire la table
+        if guild.id in self.__triggers_cache:
+            triggers = [t for t in self.__triggers_cache[guild.id] if t['label'] != label]
+            triggers.append({'label': label, 'search': search, 'replace': replace})
+            self.__triggers_cache[guild.id] = triggers
+        self.__invalidate_compiled_caches(guild)
     
     def delete_trigger(self, guild: discord.Guild, label: str):
         """Supprime un déclencheur pour le serveur"""
         self.data.get(guild).execute("DELETE FROM link_fixes WHERE label = ?", (label,))
+        if guild.id in self.__triggers_cache:
+            self.__triggers_cache[guild.id] = [t for t in self.__triggers_cache[guild.id] if t['label'] != label]
+        self.__invalidate_compiled_caches(guild)
     
     # Cache des déclencheurs ---------------------------------------------------------------
     
     def get_triggers_cache(self, guild: discord.Guild):
         """Renvoie la liste des déclencheurs pour le serveur"""
-        if guild.id not in self.__triggers_cache:
-            self.__triggers_cache[guild.id] = self.get_triggers(guild)
-        return self.__triggers_cache[guild.id]
+        if guild.id in self.__triggers_cache:
+            self.__triggers_cache.move_to_end(guild.id)
+            return self.__triggers_cache[guild.id]
+        
+        triggers = self.get_triggers(guild)
+        self.__triggers_cache[guild.id] = triggers
+        if len(self.__triggers_cache) > TRIGGERS_CACHE_SIZE:
+            evicted, _ = self.__triggers_cache.popitem(last=False)
+            self.__labels_cache.pop(evicted, None)
+        return triggers
     
-    def update_triggers_cache(self, guild: discord.Guild):
-        """Met à jour la liste des déclencheurs pour le serveur"""
-        self.__triggers_cache[guild.id] = self.get_triggers(guild)
+    def __invalidate_compiled_caches(self, guild: discord.Guild):
+        # Ces caches sont indépendants de celui des déclencheurs (qui a pu être évincé) : on les vide systématiquement
+        self.__patterns_cache.pop(guild.id, None)
+        self.__labels_cache.pop(guild.id, None)
+    
+    def get_labels_cache(self, guild: discord.Guild) -> tuple[str, ...]:
+        """Renvoie les labels des déclencheurs du serveur"""
+        if guild.id not in self.__labels_cache:
+            self.__labels_cache[guild.id] = tuple(t['label'] for t in self.get_triggers_cache(guild))
+        return self.__labels_cache[guild.id]
+        
+    def get_patterns_cache(self, guild: discord.Guild) -> tuple[re.Pattern | None, list[tuple[re.Pattern, str, str | None]]]:
+        """Renvoie les déclencheurs compilés pour le serveur"""
+        if guild.id in self.__patterns_cache:
+            self.__patterns_cache.move_to_end(guild.id)
+            return self.__patterns_cache[guild.id]
+        
+        compiled = self.__compile_triggers(self.get_triggers_cache(guild))
+        self.__patterns_cache[guild.id] = compiled
+        if len(self.__patterns_cache) > TRIGGERS_CACHE_SIZE:
+            self.__patterns_cache.popitem(last=False)
+        return compiled
+    
+    def __compile_triggers(self, triggers: list[dict]) -> tuple[re.Pattern | None, list[tuple[re.Pattern, str, str | None]]]:
+        patterns = []
+        for trigger in triggers:
+            try:
+                patterns.append((re.compile(trigger['search'], re.IGNORECASE), trigger['replace'], self.__required_literal(trigger['search'])))
+            except re.error:
+                logger.warning(f"Déclencheur '{trigger['label']}' ignoré : motif invalide ({trigger['search']})")
+        
+        # Tous les motifs sont réunis en une seule alternative pour ne parcourir le texte qu'une fois
+        # (impossible si un motif contient ses propres groupes : leurs références seraient décalées)
+        union = None
+        if patterns and not any(pattern.groups for pattern, _, _ in patterns):
+            try:
+                union = re.compile('|'.join(f'(?P<t{i}>{pattern.pattern})' for i, (pattern, _, _) in enumerate(patterns)), re.IGNORECASE)
+            except re.error:
+                logger.warning("Impossible de combiner les déclencheurs, ils seront appliqués un par un")
+        return union, patterns
+    
+    def __required_literal(self, search: str) -> str | None:
+        """Renvoie un morceau de texte (en minuscules) forcément présent dans toute correspondance du motif (None si le motif est une vraie regex)"""
+        if not search.isascii(): # La casse de certains caractères Unicode ne se compare pas de façon fiable
+            return None
+        parts = search.split('.') # Le point est le seul métacaractère toléré, il apparaît dans tous les noms de domaine
+        if any(re.escape(part) != part for part in parts):
+            return None
+        return max(parts, key=len).lower() or None
+    
+    def apply_triggers(self, guild: discord.Guild, text: str) -> str:
+        """Applique les déclencheurs du serveur sur un texte"""
+        union, patterns = self.get_patterns_cache(guild)
+        # Pré-filtre : la plupart des liens ne correspondent à aucun déclencheur
+        lowered = text.lower() # Les déclencheurs ne tiennent pas compte de la casse
+        active = [literal is None or literal in lowered for _, _, literal in patterns]
+        if not any(active):
+            return text
+        if union:
+            if not union.search(text): # Évite d'allouer une copie du texte quand rien ne correspond
+                return text
+            return union.sub(lambda m: m.expand(patterns[int(m.lastgroup[1:])][1]), text)
+        for (pattern, replace, _), is_active in zip(patterns, active):
+            if is_active:
+                text = pattern.sub(replace, text)
+        return text
         
     # Utils ---------------------------------------------------------------
     
     def get_label_for(self, base_url: str) -> str | None:
         """Détermine automatiquement un label pour une URL"""
         # On ne garde que la partie "nom de domaine"
-        base_url = re.sub(r'^(https?://)?(www\.)?', '', base_url)
-        base_url = re.sub(r'\/.*$', '', base_url)
+        try:
+            host = urlsplit(base_url if '://' in base_url else f'http://{base_url}').hostname
+        except ValueError:
+            return None
+        if not host:
+            return None
+        host = host.removeprefix('www.')
         
         # On vérifie que le nom de domaine est valide
-        if not re.match(r'^[a-zA-Z0-9\-\.]+$', base_url):
+        if not host or not DOMAIN_CHARS.issuperset(host):
             return None
-        return base_url.lower()
+        return host
         
     # Events ---------------------------------------------------------------
     
@@ -134,25 +244,28 @@ class WebUtils(commands.Cog):
             return
         if not message.guild:
             return
+        if 'http' not in message.content:
+            return
         
-        if not self.data.get_collection_value(message.guild, 'settings', 'EnableFixLinks', cast=bool):
+        if not self.get_setting(message.guild, 'EnableFixLinks'):
             return
         
-        triggers = self.get_triggers_cache(message.guild)
-        if not triggers:
+        if not self.get_patterns_cache(message.guild)[1]:
             return
         
-        # On exclut les liens précédés de \
-        links = re.findall(r'(?<!\\)(https?://[^\s]+)', message.content)
+        links = URL_REGEX.findall(message.content)
         if not links:
             return
         
-        links_content = '\n'.join(links)
-        for trigger in triggers:
-            links_content = re.sub(trigger['search'], trigger['replace'], links_content)
+        original = '\n'.join(links)
+        links_content = self.apply_triggers(message.guild, original)
         
-        if links_content != '\n'.join(links):
-            replace_msg = await message.reply(links_content, mention_author=False)
+        if links_content != original:
+            # Le bouton est envoyé avec la réponse, le message de remplacement est lié à la vue après coup
+            view = CancelButtonView(message) if self.get_setting(message.guild, 'CancelFixButton') else None
+            replace_msg = await message.reply(links_content, view=view, mention_author=False)
+            if view is not None:
+                view.replace_msg = replace_msg
             await asyncio.sleep(0.1) # On attend un peu pour éviter que Discord bloque l'édition
             try:
                 await message.edit(suppress=True)
@@ -160,9 +273,6 @@ class WebUtils(commands.Cog):
                 pass
             except discord.Forbidden:
                 pass
-            if self.data.get_collection_value(message.guild, 'settings', 'CancelFixButton', cast=bool):
-                view = CancelButtonView(message, replace_msg)
-                await replace_msg.edit(view=view)
         
     # Configuration ===============================================================
     
@@ -180,7 +290,7 @@ class WebUtils(commands.Cog):
         if not isinstance(interaction.guild, discord.Guild):
             return await interaction.response.send_message("Cette commande n'est pas disponible en MP", ephemeral=True)
         
-        self.data.set_keyvalue_table_value(interaction.guild, 'settings', 'EnableLinkFix', int(enable))
+        self.set_setting(interaction.guild, 'EnableFixLinks', enable)
         await interaction.response.send_message(f"**Correction de liens** • La correction de liens est maintenant **{'activée' if enable else 'désactivée'}**\nUtilisez `/fixlinks list` pour afficher les correcteurs configurés", ephemeral=True)
     
     @fixlinks_group.command(name='cancelbutton')
@@ -192,7 +302,7 @@ class WebUtils(commands.Cog):
         if not isinstance(interaction.guild, discord.Guild):
             return await interaction.response.send_message("Cette commande n'est pas disponible en MP", ephemeral=True)
         
-        self.data.set_keyvalue_table_value(interaction.guild, 'settings', 'CancelFixButton', int(enable))
+        self.set_setting(interaction.guild, 'CancelFixButton', enable)
         await interaction.response.send_message(f"**Bouton d'annulation** • Le bouton d'annulation est maintenant **{'activé' if enable else 'désactivé'}**", ephemeral=True)
     
     @fixlinks_group.command(name='list')
@@ -219,7 +329,7 @@ class WebUtils(commands.Cog):
     async def fixlinks_set(self, interaction: Interaction, search: str, replace: str):
         """Ajouter ou modifier un déclencheur pour corriger les liens
         
-        :param search: Portion de lien à remplacer (ex: https://twitter.com/)
+        :param search: Portion de lien à remplacer, sans tenir compte de la casse (ex: https://twitter.com/)
         :param replace: Remplacement à effectuer (ex: https://vxtwitter.com/)
         """
         if not isinstance(interaction.guild, discord.Guild):
@@ -235,10 +345,9 @@ class WebUtils(commands.Cog):
         if not label:
             return await interaction.response.send_message("**Erreur** • Le nom de domaine semble invalide", ephemeral=True)
         
-        edit = self.get_trigger(interaction.guild, label) is not None
+        edit = label in self.get_labels_cache(interaction.guild)
         
         self.set_trigger(interaction.guild, label, search, replace)
-        self.update_triggers_cache(interaction.guild)
         await interaction.response.send_message(f"**Correcteur `{label}` {'modifié' if edit else 'ajouté'}** • `{search}` → `{replace}`", ephemeral=True)
         
     @fixlinks_group.command(name='remove')
@@ -250,11 +359,10 @@ class WebUtils(commands.Cog):
         if not isinstance(interaction.guild, discord.Guild):
             return await interaction.response.send_message("Cette commande n'est pas disponible en MP", ephemeral=True)
         
-        if not self.get_trigger(interaction.guild, label):
+        if label not in self.get_labels_cache(interaction.guild):
             return await interaction.response.send_message(f"**Erreur** • Le correcteur `{label}` n'existe pas", ephemeral=True)
         
         self.delete_trigger(interaction.guild, label)
-        self.update_triggers_cache(interaction.guild)
         await interaction.response.send_message(f"**Correcteur `{label}` supprimé** • Ces liens ne seront plus détectés et corrigés", ephemeral=True)
         
     @fixlinks_remove.autocomplete('label')
@@ -262,8 +370,7 @@ class WebUtils(commands.Cog):
         guild = interaction.guild
         if not guild:
             return []
-        labels = [t['label'] for t in self.get_triggers_cache(guild)]
-        r = fuzzy.finder(current, labels)
+        r = fuzzy.finder(current, self.get_labels_cache(guild))
         return [app_commands.Choice(name=s, value=s) for s in r]
 
 async def setup(bot):